@@ -3,15 +3,246 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 import numpy as np
 import os
-from scipy.optimize import curve_fit
-import math
+import pathlib
+import shutil
+import multiprocessing
+from itertools import starmap
+from concurrent.futures import ThreadPoolExecutor
+from scipy.optimize import least_squares
+from numba import njit
+
+
+@njit(fastmath=True, cache=True)
+def _binding_kernel(conc, t, dissoc_time, t_d, kon, koff, rmax, out, e):
+    '''
+    Writes the 1to1 response into out in a single pass, using the association phase for t < dissoc_time and
+    the dissociation phase from t_d onwards. The exponential used at each point is written into e. Points are
+    expected to be grouped by concentration, as in combo_X.
+    '''
+    
+    kd = koff / kon
+    r0 = 0.
+    r0_conc = -1.
+    for i in range(t.shape[0]):
+        c = conc[i]
+        if t[i] < dissoc_time:
+            e[i] = np.exp(-(kon * c + koff) * t[i])
+            out[i] = (c * rmax) / (c + kd) * (1 - e[i])
+        else:
+            #response at the start of dissociation, only recomputed when the concentration changes
+            if c != r0_conc:
+                r0 = (c * rmax) / (c + kd) * (1 - np.exp(-(kon * c + koff) * t_d))
+                r0_conc = c
+            e[i] = np.exp(-koff * (t[i] - t_d))
+            out[i] = r0 * e[i]
+
+
+@njit(fastmath=True, cache=True)
+def _binding_jac_kernel(conc, t, dissoc_time, t_d, kon, koff, rmax, e, jac):
+    '''
+    Writes the Jacobian of the 1to1 response with respect to (kon, koff, rmax) into jac in a single pass, reusing
+    the exponentials e written by _binding_kernel at the same kon and koff.
+    '''
+    
+    r0 = 0.
+    r0_kon = 0.
+    r0_koff = 0.
+    r0_rmax = 0.
+    r0_conc = -1.
+    for i in range(t.shape[0]):
+        c = conc[i]
+        s = kon * c + koff
+        frac = c * kon / s
+        if t[i] < dissoc_time:
+            jac[i, 0] = rmax * (c * koff / s**2 * (1 - e[i]) + frac * c * t[i] * e[i])
+            jac[i, 1] = rmax * (-c * kon / s**2 * (1 - e[i]) + frac * t[i] * e[i])
+            jac[i, 2] = frac * (1 - e[i])
+        else:
+            #r0 and its derivatives at the start of dissociation, only recomputed when the concentration changes
+            if c != r0_conc:
+                e_d = np.exp(-s * t_d)
+                r0_rmax = frac * (1 - e_d)
+                r0 = rmax * r0_rmax
+                r0_kon = rmax * (c * koff / s**2 * (1 - e_d) + frac * c * t_d * e_d)
+                r0_koff = rmax * (-c * kon / s**2 * (1 - e_d) + frac * t_d * e_d)
+                r0_conc = c
+            jac[i, 0] = r0_kon * e[i]
+            jac[i, 1] = (r0_koff - (t[i] - t_d) * r0) * e[i]
+            jac[i, 2] = r0_rmax * e[i]
+
+
+class _OneToOne():
+    '''
+    1to1 binding model for X = (conc, t), with dissociation starting at the first time point at or after
+    dissoc_time in seconds. Calling the model with (kon, koff, rmax) returns the response at the points of X and
+    jac returns its Jacobian.
+    
+    The start of dissociation and the output buffers only depend on X, so they are set up once here instead of
+    on every residual evaluation. The returned arrays are the model's own buffers (out and jac_out) and are
+    overwritten by the next call, so copy them if they need to be kept.
+    
+    X and the buffers are stored as dtype. The kernels compute in float64 either way, so float32 only reduces
+    the memory of the stored values along with their precision.
+    '''
+    
+    def __init__(self, X, dissoc_time, dtype=np.float64):
+        
+        conc, t = np.asarray(X, dtype=dtype)
+        self.conc = conc
+        self.t = t
+        self.dissoc_time = dissoc_time
+        
+        #X holds one curve after another, each restarting at the same time points
+        n_curves = np.count_nonzero(np.diff(t) < 0) + 1
+        stride = len(t) // n_curves
+        dissoc_idx = int(np.searchsorted(t[:stride], dissoc_time))
+        self.t_d = t[dissoc_idx]
+        
+        #scratch buffers reused by every evaluation
+        self.out = np.empty(len(t), dtype=dtype)
+        self.jac_out = np.empty((len(t), 3), dtype=dtype)
+        
+        #(kon, koff) and exponentials of the last evaluation. The optimizer evaluates the residual and the Jacobian
+        #at the same parameters, so jac reuses them instead of calling np.exp again
+        self._last = (None, np.empty(len(t), dtype=dtype))
+    
+    def __call__(self, kon, koff, rmax):
+        
+        e = self._last[1]
+        _binding_kernel(self.conc, self.t, self.dissoc_time, self.t_d, kon, koff, rmax, self.out, e)
+        self._last = ((kon, koff), e)
+        
+        return self.out
+    
+    def jac(self, kon, koff, rmax):
+        '''
+        Analytic Jacobian of the model with respect to (kon, koff, rmax), shape (len(t), 3).
+        '''
+        
+        if self._last[0] != (kon, koff):
+            self(kon, koff, rmax)
+        _binding_jac_kernel(self.conc, self.t, self.dissoc_time, self.t_d, kon, koff, rmax, self._last[1],
+                            self.jac_out)
+        
+        return self.jac_out
+
+
+def _initial_guess(time, Y, concs, dissoc_time):
+    '''
+    Estimates (kon, koff, rmax) from the data, so that the starting point of a fit does not depend on the units
+    of the concentrations. rmax is the largest response, koff the log-slope of the dissociation phase of the
+    largest curve, and kon follows from how fast each curve reaches 63% of its response at dissociation.
+    
+    Arguments:
+        time              Time values in seconds (array)
+        Y                 Responses, one row per curve (2D array)
+        concs             Concentration of each curve (array)
+        dissoc_time       The time that dissociation began in seconds (float)
+        
+    Returns:
+        (kon, koff, rmax)
+    '''
+    
+    Y = np.atleast_2d(Y)
+    concs = np.atleast_1d(np.asarray(concs, dtype=np.float64))
+    assoc = time < dissoc_time
+    
+    rmax = Y.max() if Y.max() > 0 else 1.
+    
+    #dissociation of the largest curve, ignoring the tail that has decayed into the noise
+    top = np.argmax(Y.max(axis=1))
+    y_diss = Y[top, ~assoc]
+    keep = y_diss > 0.1 * y_diss.max()
+    koff = 0.
+    if np.count_nonzero(keep) > 1:
+        koff = -np.polyfit(time[~assoc][keep], np.log(y_diss[keep]), 1)[0]
+    if not koff > 0:
+        koff = 1 / (time[-1] - time[0])
+    
+    #observed association rate kobs = kon * conc + koff, from the time to reach 63% of the final response
+    kon_list = []
+    for y, conc in zip(Y, concs):
+        y_assoc = y[assoc]
+        if conc <= 0 or len(y_assoc) == 0 or y_assoc[-1] <= 0:
+            continue
+        t63 = time[assoc][np.argmax(y_assoc >= (1 - np.exp(-1)) * y_assoc[-1])]
+        if t63 > 0:
+            kobs = 1 / t63
+            kon_list.append((kobs - koff) / conc if kobs > koff else kobs / conc)
+    #without a usable association phase, assume Kd is around the median concentration
+    kon = np.median(kon_list) if kon_list else koff / np.median(concs[concs > 0] if np.any(concs > 0) else [1.])
+    
+    return kon, koff, rmax
+
+
+def _fit_model(model, Y, p0, ftol=1e-8, xtol=1e-8, check_finite=False):
+    '''
+    Fits model to Y with least_squares starting from p0, using the trust region reflective method with kon, koff
+    and rmax bounded to be positive and the model's analytic Jacobian. Y is cast to the dtype of the model. A fit
+    that never moves from p0, such as one to a curve at zero concentration whose response does not depend on kon,
+    counts as failed.
+    
+    Returns:
+        popt              Fitted (kon, koff, rmax) (array)
+    '''
+    
+    if check_finite:
+        Y = np.asarray_chkfinite(Y, dtype=model.out.dtype)
+    else:
+        Y = np.asarray(Y, dtype=model.out.dtype)
+    
+    res = least_squares(lambda p: model(*p) - Y, x0=p0, jac=lambda p: model.jac(*p),
+                        bounds=([0, 0, 0], [np.inf]*3), method='trf', x_scale='jac', ftol=ftol, xtol=xtol)
+    if not res.success:
+        raise RuntimeError(res.message)
+    if res.nfev == 1:
+        raise RuntimeError('Fit did not move from the initial guess')
+    
+    return res.x
+
+
+def _fit_one(col_data, conc, time, dissoc_time, p0=None, ftol=1e-8, xtol=1e-8, check_finite=False,
+             dtype=np.float64):
+    '''
+    Fits the 1to1 model to a single binding curve. Defined at module level so it can be sent to a
+    multiprocessing pool.
+    
+    Arguments:
+        col_data          Response values of the curve (array)
+        conc              Concentration of the curve (float)
+        time              Time values of the curve in seconds (array)
+        dissoc_time       The time that dissociation began in seconds (float)
+        p0                Initial guess for (kon, koff, rmax), estimated from the curve if None (tuple)
+        ftol, xtol        Relative tolerances passed to least_squares (float)
+        check_finite      Whether to check the data for NaNs and infs (bool)
+        dtype             Floating point type the model is evaluated with (numpy dtype)
+        
+    Returns:
+        (kon, koff, rmax), or (None, None, None) if the fit failed
+    '''
+    
+    combo_X = np.vstack([np.full(len(time), conc, dtype=np.float64), time])
+    binding = _OneToOne(combo_X, dissoc_time, dtype=dtype)
+    if p0 is None:
+        p0 = _initial_guess(time, col_data, conc, dissoc_time)
+    try:
+        popt = _fit_model(binding, col_data, p0=p0, ftol=ftol, xtol=xtol, check_finite=check_finite)
+        return tuple(popt)
+    except:
+        return None, None, None
+
 
 class Octet():
     '''
     A convenience class for reading in and performing various plots and fits on Octet BLI data.
     '''
     
-        def save_xls_to_tsv(self, filepath):
+    def __init__(self):
+        
+        #combo_X and model of the last global fit, reused when the next fit is on the same data
+        self._last_fit = None
+    
+    def save_xls_to_tsv(self, filepath):
         '''
         Creates a tsv file from the xls file formatted from the Octet.
         
@@ -19,15 +250,15 @@ class Octet():
             filepath takes in the filepath of the file of 'xls'
             
         '''
-        print('Saving {} as {}!'.format(filepath, filepath.replace('xls', 'tsv')))
+        tsv_path = pathlib.Path(filepath).with_suffix('.tsv')
+        print('Saving {} as {}!'.format(filepath, tsv_path))
         try:
-            with open(filepath) as f:
-                lines = f.readlines()
-
-            f = open(filepath.replace('xls','tsv'), 'w')
-            for line in lines[4:]:
-                f.write(line)
-            f.close()
+            #skips the 4 header lines and streams the rest, rather than reading the whole file into memory
+            with open(filepath) as src:
+                for _ in range(4):
+                    next(src)
+                with open(tsv_path, 'w') as dst:
+                    shutil.copyfileobj(src, dst)
         except:
             print('File {} is not a .xls!'.format(filepath))
 
@@ -46,33 +277,23 @@ class Octet():
         '''
         print('Reading in data')
         
-        files = sorted([file for file in os.listdir(path) if file.endswith(filetype)])
-
-        
-        out = None
+        files = sorted(pathlib.Path(path).glob('*' + filetype))
         
-        for file in files:
-            
-            if path[-1] != '/':
-                path = path + '/'
-            filepath = ''.join([path,file])
+        def read_file(filepath):
             try:
-                if isinstance(out, pd.DataFrame):
-                    if filetype == '.xls':
-                        self.save_xls_to_tsv(filepath)
-                        filepath = filepath.replace('xls', 'tsv')
-                    tmp = pd.read_csv(filepath, sep='\t')
-                    out[file.strip(filetype)] = tmp['Data1']
-                else:
-                    if filetype == '.xls':
-                        self.save_xls_to_tsv(filepath)
-                        filepath = filepath.replace('xls', 'tsv')
-                    out = pd.read_csv(filepath, sep='\t')
-                    out = out[['Time1', 'Data1']]
-                    out = out.rename(columns={"Time1": "Time", "Data1": file.strip(filetype)})
-                    print(out)
+                if filetype == '.xls':
+                    self.save_xls_to_tsv(filepath)
+                    filepath = filepath.with_suffix('.tsv')
+                return pd.read_csv(filepath, sep='\t', usecols=['Time1', 'Data1'], dtype=np.float64, engine='c')
             except:
-                print(' '.join([filepath, 'not found!']))
+                print('{} not found!'.format(filepath))
+        
+        #files are independent and pandas' C parser releases the GIL, so they are read concurrently
+        with ThreadPoolExecutor(max_workers=8) as ex:
+            tables = [table for table in ex.map(read_file, files) if table is not None]
+        
+        #time is taken from the first file, followed by the response of every file
+        out = pd.concat([tables[0]['Time1']] + [table['Data1'] for table in tables], axis=1)
 
         assert len(out.columns)==len(var_list), 'Variable list does not match number of columns!'
         out.columns = var_list
@@ -91,8 +312,9 @@ class Octet():
             scale    Str option on whether yscale is linear (default) or log
         '''
         
+        time = data['Time'].to_numpy()
         for col in data.columns[~data.columns.str.contains('Time')]:
-            s = sns.scatterplot(data=data, x='Time', y = col, edgecolor='None', label=col, s=5)
+            s = sns.scatterplot(x = time, y = data[col].to_numpy(), edgecolor='None', label=col, s=5)
             plt.ylabel('Response (nm)')
             plt.xlabel('Time (s)')
             plt.legend(loc = 'best', fontsize='x-small')
@@ -103,7 +325,9 @@ class Octet():
                 
         return s
     
-    def fit_data(self, data, conc_range, dissoc_time, binding_model='1to1', global_fit=True, scale='linear'):
+    def fit_data(self, data, conc_range, dissoc_time, binding_model='1to1', global_fit=True, scale='linear',
+                 workers=None, p0=None, warm_start=True, ftol=1e-8, xtol=1e-8, check_finite=False,
+                 dtype=np.float64):
         '''
         Function that fits binding curves to data. Can perform global or individual fits to data. Currently only
         supports a 1to1 binding model.
@@ -115,36 +339,25 @@ class Octet():
             binding_model     Which type of binding model to fit (str)
             global_fit        Boolean on whether or not to perform a global fit
             scale             Whether to plot the y axis as linear (default) or log (str)
+            workers           Number of processes used for individual fits, default (None) uses the number of CPUs
+                              (int)
+            p0                Initial guess for (kon, koff, rmax). By default it is estimated from the data, which
+                              works for concentrations in any unit (tuple)
+            warm_start        Whether to first fit a single curve and use its result as the initial guess, default
+                              True. Global fits are seeded by the curve at the median concentration, individual
+                              fits by the curve with the median maximum response (bool)
+            ftol, xtol        Relative tolerances passed to least_squares, default 1e-8 as in scipy (float)
+            check_finite      Whether to check the data for NaNs and infs, default False (bool)
+            dtype             Floating point type the data and model are stored in during fitting, default float64.
+                              np.float32 halves the memory of the stored arrays but not the fitting time, and
+                              float32 fits can stop on the xtol test before reaching full precision (numpy dtype)
             
         Returns:
             popt              Either tuple (global) or dataframe (individual) of fitted values
-            s                 Seaborn plot object of fitted curves
+            s                 Matplotlib axes of fitted curves
         '''
         
-        def association(t, conc, kon, koff, rmax):
-            return (conc * rmax) / (conc + (koff / kon)) * (1 - math.e**(-1 * (kon * conc + koff) * t))
-
-        def dissociation(t, r0, koff):
-            return r0 * math.e**(-1 * koff * t)
-        
-        def binding(X, kon, koff, rmax):
-            
-            conc, t = X
-            
-            r0 = association(t[t==t[dissoc_time*5]], conc[t==t[dissoc_time*5]], kon, koff, rmax)
-            new_r0 = []
-            for item in r0:
-                new_r0.extend([item]*int(len(t[t>=dissoc_time])/len(set(conc))))
-            r0 = new_r0
-            
-            out = np.empty(len(t))
-            out[t<dissoc_time] = association(t[t<dissoc_time], conc[t<dissoc_time], kon, koff, rmax)
-            out[t>=dissoc_time] = dissociation(t[t>=dissoc_time] - t[dissoc_time*5], r0, koff)
-            
-            return out
-         
-        
-        time = np.array(data['Time'])
+        time = data['Time'].to_numpy(copy=False)
         
         #global fitting
         if global_fit == True:
@@ -153,27 +366,43 @@ class Octet():
             if binding_model == '1to1':
             
                 columns = data.columns[~data.columns.str.contains('Time')]
-                combo_Y = []
-                for col in columns:
-                    combo_Y.extend(data[col].to_list())
-                    
-                conc_list = []
-                t_list = []
-                for conc in conc_range:
-                    conc_list.extend([conc]*len(time))
-                    t_list.extend(time)
+                combo_Y = np.concatenate([data[col].to_numpy(copy=False) for col in columns])
+                
+                #the last fit is only reused if its time points and responses match, so in-place edits are picked up
+                key = (tuple(conc_range), dissoc_time, np.dtype(dtype).name, None if p0 is None else tuple(p0),
+                       warm_start, ftol, xtol)
+                last = self._last_fit
+                if (last is not None and last[0] == key and np.array_equal(last[1], time)
+                        and np.array_equal(last[2], combo_Y)):
+                    combo_X, binding, p0 = last[3:]
+                else:
+                    conc_arr = np.asarray(conc_range, dtype=np.float64)
+                    combo_X = np.vstack([np.repeat(conc_arr, len(time)), np.tile(time, len(conc_arr))])
+                    binding = _OneToOne(combo_X, dissoc_time, dtype=dtype)
                     
-                combo_X = np.row_stack([np.array(conc_list), np.array(t_list)])
+                    #warm start: the curve at the median concentration is fitted alone and seeds the global fit
+                    seed_popt = (None, None, None)
+                    if warm_start:
+                        seed = np.argsort(conc_arr)[len(conc_arr)//2]
+                        seed_popt = _fit_one(data[columns[seed]].to_numpy(copy=False), conc_arr[seed], time,
+                                             dissoc_time, p0, ftol, xtol, check_finite, dtype)
+                    if seed_popt[0] is not None:
+                        p0 = seed_popt
+                    elif p0 is None:
+                        p0 = _initial_guess(time, combo_Y.reshape(-1, len(time)), conc_arr, dissoc_time)
+                    self._last_fit = (key, time.copy(), combo_Y, combo_X, binding, p0)
 
-                popt, pcov = curve_fit(binding, combo_X, combo_Y)
+                popt = _fit_model(binding, combo_Y, p0=p0, ftol=ftol, xtol=xtol,
+                                  check_finite=check_finite)
                 print('Fitted Kd is', popt[1]/popt[0])
                 
-                fit_data = binding(combo_X, *popt)
+                fit_data = binding(*popt)
                 #splits combined response values into correct size chunks
                 split_fit = [fit_data[i:i + len(time)] for i in range(0, len(fit_data), len(time))]
                 
                 for conc, fit in zip(conc_range, split_fit):
-                    s = sns.scatterplot(x = time, y = fit, label=conc, s=1, color='black', edgecolor='None')
+                    plt.plot(time, fit, color='black', lw=0.5, label=str(conc))
+                    s = plt.gca()
                     plt.ylabel('Response (nm)')
                     plt.xlabel('Time (s)')
                     plt.legend(loc = 'best', fontsize='x-small')
@@ -188,28 +417,52 @@ class Octet():
             
             if binding_model == '1to1':
                 
+                columns = data.columns[~data.columns.str.contains('Time')]
+                jobs = [(data[col].to_numpy(copy=False), conc, time, dissoc_time, p0, ftol, xtol, check_finite, dtype)
+                        for col, conc in zip(columns, conc_range)]
+                
+                #warm start: the curve with the median maximum response is fitted first and seeds the others
+                seed = None
+                if warm_start and len(jobs) > 1:
+                    seed = np.argsort([data[col].max() for col in columns])[len(columns)//2]
+                    seed_popt = _fit_one(*jobs[seed])
+                    if seed_popt[0] is not None:
+                        jobs = [job[:4] + (seed_popt,) + job[5:] for job in jobs]
+                    other_jobs = jobs[:seed] + jobs[seed + 1:]
+                else:
+                    other_jobs = jobs
+                
+                #curves are independent, so they are fitted in parallel
+                if workers is None:
+                    workers = os.cpu_count() or 1
+                if workers == 1 or len(other_jobs) <= 1:
+                    results = list(starmap(_fit_one, other_jobs))
+                else:
+                    with multiprocessing.Pool(min(workers, len(other_jobs))) as p:
+                        results = p.starmap(_fit_one, other_jobs)
+                if seed is not None:
+                    results.insert(seed, seed_popt)
+                
                 kon_list = []
                 koff_list = []
                 rmax_list = []
-                for col, conc in zip(data.columns[~data.columns.str.contains('Time')], conc_range):
-                    combo_X = np.row_stack([np.array([conc]*len(time)), time])
-                    try:
-                        popt, pcov = curve_fit(binding, combo_X, data[col])
-                        kon_list.append(popt[0])
-                        koff_list.append(popt[1])
-                        rmax_list.append(popt[2])
-
-                        fit = binding(combo_X, *popt)
-                        s = sns.scatterplot(x = time, y = fit, label=conc, s=1, color='black', edgecolor='None')
-                        plt.ylabel('Response (nm)')
-                        plt.xlabel('Time (s)')
-                        plt.legend(loc = 'best', fontsize='x-small')
+                for conc, (kon, koff, rmax) in zip(conc_range, results):
+                    kon_list.append(kon)
+                    koff_list.append(koff)
+                    rmax_list.append(rmax)
                     
-                    except:
+                    if kon is None:
                         print('Fitting failed for', conc)
-                        kon_list.append(None)
-                        koff_list.append(None)
-                        rmax_list.append(None)
+                        continue
+                    
+                    combo_X = np.vstack([np.full(len(time), conc, dtype=np.float64), time])
+                    binding = _OneToOne(combo_X, dissoc_time, dtype=dtype)
+                    fit = binding(kon, koff, rmax)
+                    plt.plot(time, fit, color='black', lw=0.5, label=str(conc))
+                    s = plt.gca()
+                    plt.ylabel('Response (nm)')
+                    plt.xlabel('Time (s)')
+                    plt.legend(loc = 'best', fontsize='x-small')
                         
                 
                 popt = pd.DataFrame({'Kon':kon_list,'Koff':koff_list,'Rmax':rmax_list})